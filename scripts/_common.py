@@ -0,0 +1,49 @@
+# shared config and helpers for the corpus scripts (freeze_corpus.py, getRepo.py).
+
+import os
+import json
+from pathlib import Path
+
+try:
+    import orjson  # optional, much faster serialization
+except ImportError:
+    orjson = None
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+PROJECT_ROOT = SCRIPT_DIR.parent
+
+# === CONFIG ===
+REPOS_FILE = PROJECT_ROOT / "repos.txt"
+LOGS_DIR = PROJECT_ROOT / "logs"
+CORPUS = LOGS_DIR / "corpus.jsonl"
+
+GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
+HEADERS = {"Authorization": f"token {GITHUB_TOKEN}"} if GITHUB_TOKEN else {}
+
+# === HELPER FUNCTIONS ===
+
+def load_repos():
+    """Read repo names from repos.txt."""
+    if not REPOS_FILE.exists():
+        raise SystemExit(f"Missing {REPOS_FILE}. Put one owner/name per line.")
+    with open(REPOS_FILE) as f:
+        return [ln.strip() for ln in f if ln.strip() and not ln.startswith("#")]
+
+def loads(data):
+    """Parse JSON from bytes/str, with orjson when it's installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(obj):
+    """Serialize `obj` to compact JSON bytes, with orjson when it's installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+def dumps_indented(obj, sort_keys=False):
+    """Serialize `obj` to 2-space indented JSON bytes, with orjson when it's installed."""
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2 | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return orjson.dumps(obj, option=option)
+    return json.dumps(obj, indent=2, sort_keys=sort_keys).encode()
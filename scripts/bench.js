@@ -1,11 +1,15 @@
 const { spawnSync, execSync } = require("child_process");
-const { readdirSync, writeFileSync, existsSync, mkdirSync, statSync } = require("fs");
+const { readdirSync, readFileSync, writeFileSync, existsSync, mkdirSync, statSync } = require("fs");
 const { join, basename } = require("path");
 
 const ROOT = process.cwd();
 const PROJECTS_DIR = join(ROOT, "projects");
 const LOGS_DIR = join(ROOT, "logs");
 if (!existsSync(LOGS_DIR)) mkdirSync(LOGS_DIR, { recursive: true });
+const TS_VERSION = process.env.TS_VERSION || "latest";
+const TOOLS_DIR = join(ROOT, "tools");
+const TSC_BIN = join(TOOLS_DIR, "node_modules", ".bin", "tsc");
+const TS_SPEC_FILE = join(TOOLS_DIR, "typescript.spec"); // the TS_VERSION tools/ was installed for
 
 function run(cmd, args, cwd, extraEnv = {}) {
   return spawnSync(cmd, args, { cwd, encoding: "utf8", maxBuffer: 64 * 1024 * 1024, env: { ...process.env, ...extraEnv } });
@@ -28,6 +32,25 @@ function installDeps(dir) {
   execSync("npm install --ignore-scripts", { cwd: dir, stdio: "inherit" });
 }
 
+// install TypeScript once into tools/ instead of letting npx resolve it for every tsconfig;
+// reinstalls whenever TS_VERSION (a version, range or dist-tag) differs from the last install.
+// returns the tsc path, or null with the reason in tscError if the install failed
+let tscError = null;
+function ensureTsc() {
+  try {
+    if (readFileSync(TS_SPEC_FILE, "utf8").trim() === TS_VERSION && existsSync(TSC_BIN)) return TSC_BIN;
+  } catch {}
+  try {
+    execSync(`npm install --prefix "${TOOLS_DIR}" --no-save --no-package-lock typescript@${TS_VERSION}`, { stdio: "inherit" });
+    writeFileSync(TS_SPEC_FILE, TS_VERSION + "\n");
+    return TSC_BIN;
+  } catch (e) {
+    tscError = e.message;
+    console.warn(`Install failed for typescript@${TS_VERSION}: ${e.message}`);
+    return null;
+  }
+}
+
 function findTsconfigsRecursive(dir, depth = 0, maxDepth = 4, out = []) {
   const deny = new Set(["node_modules", ".git", "dist", "build", "coverage", ".next", "out"]);
   if (depth > maxDepth) return out;
@@ -55,22 +78,33 @@ const entries = readdirSync(PROJECTS_DIR).filter(n => {
   try { return statSync(join(PROJECTS_DIR, n)).isDirectory(); } catch { return false; }
 });
 
+const tsc = ensureTsc();
 const results = [];
 for (const name of entries) {
   const dir = join(PROJECTS_DIR, name);
-  console.log(`\n=== ${name}: install ===`);
-  try { installDeps(dir); } catch (e) { console.warn(`Install failed for ${name}: ${e.message}`); }
+  // look for tsconfigs first: a project with nothing to compile doesn't need its deps installed
   const tsconfigs = findTsconfigsRecursive(dir);
   if (tsconfigs.length === 0) {
-    console.log(`=== ${name}: no tsconfig.json found, skipping ===`);
+    console.log(`\n=== ${name}: no tsconfig.json found, skipping ===`);
     results.push({ project: name, target: null, exitCode: 2, wallMs: 0, files: null, lines: null, memoryKB: null, totalTimeSec: null, log: null });
     continue;
   }
+  // without a compiler there is nothing to install deps for; record each tsconfig as failed
+  if (tsc) {
+    console.log(`\n=== ${name}: install ===`);
+    try { installDeps(dir); } catch (e) { console.warn(`Install failed for ${name}: ${e.message}`); }
+  }
   for (const cfg of tsconfigs) {
     const label = `${name}__${basename(join(cfg, "..")) || "root"}`;
+    if (!tsc) {
+      const logFile = `logs/${label}-tsc.log`;
+      writeFileSync(join(ROOT, logFile), `typescript@${TS_VERSION} install failed: ${tscError}\n`);
+      results.push({ project: name, target: cfg.replace(dir + "/", ""), exitCode: 1, wallMs: 0, ...parseDiag(""), log: logFile });
+      continue;
+    }
     console.log(`=== ${name}: tsc -p ${cfg} ===`);
     const t0 = Date.now();
-    const res = run("npx", ["--yes", "-p", "typescript@latest", "tsc", "--noEmit", "--pretty", "false", "--diagnostics", "--skipLibCheck", "true", "-p", cfg], dir, { NODE_OPTIONS: "--max-old-space-size=8192" });
+    const res = run(tsc, ["--noEmit", "--pretty", "false", "--diagnostics", "--skipLibCheck", "true", "-p", cfg], dir, { NODE_OPTIONS: "--max-old-space-size=8192" });
     const t1 = Date.now();
     const logFile = `logs/${label}-tsc.log`;
     writeFileSync(join(ROOT, logFile), (res.stdout || "") + (res.stderr || ""));
@@ -1,22 +1,111 @@
 # script to freeze the corpus at the latest commit on the default branch and write corpus.jsonl + CORPUS.md.
 
-import os, json, base64
-from pathlib import Path
-import requests
+import os, json, asyncio, random, time
+from urllib.parse import urlencode
+import httpx
 
-SCRIPT_DIR = Path(__file__).resolve().parent
-PROJECT_ROOT = SCRIPT_DIR.parent
+from _common import CORPUS, GITHUB_TOKEN, HEADERS, LOGS_DIR, dumps, load_repos, loads
 
-REPOS_FILE = PROJECT_ROOT / "repos.txt"
-OUT_JSONL = PROJECT_ROOT / "logs" / "corpus.jsonl"
-OUT_MD = PROJECT_ROOT / "logs" / "CORPUS.md"
+OUT_JSONL = CORPUS
+OUT_MD = LOGS_DIR / "CORPUS.md"
+# url -> {"etag", "body"} from previous runs, replayed on 304 Not Modified
+HTTP_CACHE = LOGS_DIR / ".http_cache.json"
 
-GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
-HEADERS = {"Authorization": f"token {GITHUB_TOKEN}"} if GITHUB_TOKEN else {}
+GRAPHQL_URL = "https://api.github.com/graphql"
+# repos resolved per GraphQL request (one aliased `repository` field each)
+GRAPHQL_BATCH = 20
+REPO_FIELDS = "licenseInfo { spdxId } defaultBranchRef { name target { ... on Commit { oid authoredDate } } }"
 
-def gh(url, params=None):
-    """Helper to GET a GitHub API endpoint and return parsed JSON."""
-    r = requests.get(url, headers=HEADERS, params=params or {})
+# max repos in flight at once, keeps us below GitHub's secondary rate limit
+CONCURRENCY = 10
+# retries for rate-limited (403/429) responses, and the budget below which we wait for the reset
+MAX_ATTEMPTS = 5
+RATELIMIT_FLOOR = 5
+# fsync corpus.jsonl every N rows so a crash leaves a usable partial corpus
+FSYNC_EVERY = 20
+
+def load_http_cache():
+    """Read the ETag cache written by a previous run, if any."""
+    try:
+        with open(HTTP_CACHE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# filled from HTTP_CACHE by main(), so importing this module touches no files
+_http_cache = {}
+
+def cache_repo(key):
+    """The lowercased owner/name a cache key (a /repos/... URL) belongs to."""
+    path = key.partition("?")[0].removeprefix("https://api.github.com/repos/")
+    return "/".join(path.split("/")[:2]).lower()
+
+def save_http_cache(repos):
+    """Persist the ETag cache for the next run, dropping repos no longer in repos.txt."""
+    keep = {repo.lower() for repo in repos}
+    entries = {key: entry for key, entry in _http_cache.items() if cache_repo(key) in keep}
+    HTTP_CACHE.parent.mkdir(parents=True, exist_ok=True)
+    with open(HTTP_CACHE, "w") as f:
+        json.dump(entries, f)
+
+def is_rate_limited(r):
+    """True if a 403/429 response is GitHub's primary or secondary rate limit."""
+    if r.status_code == 429:
+        return True
+    return r.status_code == 403 and (
+        "Retry-After" in r.headers
+        or r.headers.get("X-RateLimit-Remaining") == "0"
+        or "rate limit" in r.text.lower())
+
+def seconds_until_reset(r):
+    """Seconds until X-RateLimit-Reset, or 0 if unknown/past."""
+    try:
+        return max(0.0, int(r.headers["X-RateLimit-Reset"]) - time.time())
+    except (KeyError, ValueError):
+        return 0.0
+
+async def request(client, method, url, **kwargs):
+    """Send a GitHub API request, backing off instead of failing on rate limits.
+
+    Rate-limited responses are retried up to MAX_ATTEMPTS times, honouring Retry-After or the
+    reset time, else with exponential backoff. When a successful response shows the budget is
+    nearly spent, we sleep until it resets before handing it back."""
+    for attempt in range(MAX_ATTEMPTS):
+        r = await client.request(method, url, **kwargs)
+        if not is_rate_limited(r):
+            remaining = r.headers.get("X-RateLimit-Remaining")
+            if remaining is not None and remaining.isdigit() and int(remaining) < RATELIMIT_FLOOR:
+                wait = seconds_until_reset(r)
+                if wait:
+                    print(f"[rate-limit] {remaining} calls left, sleeping {wait:.0f}s until reset")
+                    await asyncio.sleep(wait)
+            return r
+        if attempt == MAX_ATTEMPTS - 1:
+            break
+
+        retry_after = r.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            delay = int(retry_after)
+        elif r.headers.get("X-RateLimit-Remaining") == "0":
+            delay = seconds_until_reset(r) + 1
+        else:
+            delay = min(60, 2 ** attempt) + random.random()
+        print(f"[rate-limit] {r.status_code} on {url}, retrying in {delay:.0f}s")
+        await asyncio.sleep(delay)
+    return r
+
+async def gh(client, url, params=None):
+    """Helper to GET a GitHub API endpoint and return parsed JSON.
+
+    Unchanged resources are revalidated with If-None-Match; a 304 costs nothing against
+    the rate limit and the body is served from the cache."""
+    params = params or {}
+    key = f"{url}?{urlencode(sorted(params.items()))}" if params else url
+    cached = _http_cache.get(key)
+    headers = {"If-None-Match": cached["etag"]} if cached else {}
+    r = await request(client, "GET", url, params=params, headers=headers)
+    if r.status_code == 304 and cached:
+        return cached["body"]
 
     # check for common errors
     if r.status_code == 401:
@@ -25,24 +114,31 @@ def gh(url, params=None):
         raise SystemExit("GitHub 403 Forbidden (rate limit). Set GITHUB_TOKEN to continue.")
     if r.status_code >= 400:
         raise SystemExit(f"GitHub {r.status_code} on {url}: {r.text[:200]}")
-    return r.json()
 
-def load_repos():
-    """Read repo names from repos.txt."""
-    if not REPOS_FILE.exists():
-        raise SystemExit(f"Missing {REPOS_FILE}. Put one owner/name per line.")
-    with open(REPOS_FILE) as f:
-        return [ln.strip() for ln in f if ln.strip() and not ln.startswith("#")]
+    body = r.json()
+    if r.headers.get("ETag"):
+        _http_cache[key] = {"etag": r.headers["ETag"], "body": body}
+    return body
 
-def latest_on_default(repo):
+async def graphql(client, query, variables):
+    """Helper to POST a GitHub GraphQL query and return (data, errors)."""
+    r = await request(client, "POST", GRAPHQL_URL, json={"query": query, "variables": variables})
+    if r.status_code == 401:
+        raise SystemExit("GitHub 401 Unauthorized. Check GITHUB_TOKEN.")
+    if r.status_code >= 400:
+        raise SystemExit(f"GitHub {r.status_code} on {GRAPHQL_URL}: {r.text[:200]}")
+    body = r.json()
+    return body.get("data") or {}, body.get("errors") or []
+
+async def latest_on_default(client, repo):
     """ For a given repo: Fetch repo info and ask for the most recent commit on that default branch."""
-    info = gh(f"https://api.github.com/repos/{repo}")
+    info = await gh(client, f"https://api.github.com/repos/{repo}")
     license_spdx = (info.get("license") or {}).get("spdx_id") or "UNKNOWN"
     branch = info.get("default_branch") or "main"
 
     # request the newest commit on that branch
-    commits = gh(f"https://api.github.com/repos/{repo}/commits",
-                 params={"sha": branch, "per_page": 1})
+    commits = await gh(client, f"https://api.github.com/repos/{repo}/commits",
+                       params={"sha": branch, "per_page": 1})
     
     # if no commits found, fail
     if not commits:
@@ -52,21 +148,67 @@ def latest_on_default(repo):
     c = commits[0]
     return license_spdx, c["sha"], c["commit"]["author"]["date"], branch
 
-def fetch_package_json(repo, ref):
+async def latest_on_default_batch(client, sem, repos):
+    """ For a batch of repos: same as latest_on_default, but all in one aliased GraphQL query.
+
+    Returns {repo: (license, sha, date, branch)} with a SystemExit in place of the tuple for
+    repos that could not be resolved. Returns {} if the whole query failed, so callers can fall
+    back to REST."""
+    decls, fields, variables = [], [], {}
+    for i, repo in enumerate(repos):
+        owner, _, name = repo.partition("/")
+        decls.append(f"$o{i}: String!, $n{i}: String!")
+        fields.append(f"r{i}: repository(owner: $o{i}, name: $n{i}) {{ {REPO_FIELDS} }}")
+        variables[f"o{i}"], variables[f"n{i}"] = owner, name
+    query = f"query({', '.join(decls)}) {{ {' '.join(fields)} }}"
+
+    async with sem:
+        try:
+            data, errors = await graphql(client, query, variables)
+        except (SystemExit, httpx.HTTPError, ValueError) as e:
+            print(f"[WARN] GraphQL batch failed, falling back to REST: {type(e).__name__}: {e}")
+            return {}
+
+    # query-wide errors (e.g. RATE_LIMITED) come back as 200 with no data and no path;
+    # that says nothing about the repos themselves, so let REST decide
+    query_errors = [err for err in errors if not err.get("path")]
+    if not data or query_errors:
+        msg = "; ".join(err.get("message") or err.get("type") or "?" for err in query_errors) or "no data"
+        print(f"[WARN] GraphQL batch failed, falling back to REST: {msg}")
+        return {}
+
+    # errors are reported per alias, e.g. {"path": ["r3"], "message": "Could not resolve ..."}
+    messages = {err["path"][0]: err.get("message") for err in errors if err.get("path")}
+
+    found = {}
+    for i, repo in enumerate(repos):
+        node = data.get(f"r{i}")
+        if not node:
+            found[repo] = SystemExit(messages.get(f"r{i}") or f"Repository {repo} not found")
+            continue
+        ref = node.get("defaultBranchRef") or {}
+        commit = ref.get("target") or {}
+        if not commit.get("oid"):
+            found[repo] = SystemExit(f"No commits found for {repo}@{ref.get('name') or 'main'}")
+            continue
+        license_spdx = (node.get("licenseInfo") or {}).get("spdxId") or "UNKNOWN"
+        found[repo] = (license_spdx, commit["oid"], commit["authoredDate"], ref["name"])
+    return found
+
+async def fetch_package_json(client, repo, ref):
     """Try to fetch and parse the repository's package.json at a specific commit SHA."""
+    # raw.githubusercontent serves the file bytes directly and doesn't count against the REST quota
+    url = f"https://raw.githubusercontent.com/{repo}/{ref}/package.json"
     try:
-        pj = gh(f"https://api.github.com/repos/{repo}/contents/package.json", params={"ref": ref})
-    except SystemExit:
+        r = await client.get(url)
+    except httpx.HTTPError:
         return None
-    
-    # contents returns an object with a "content" field on success:
-    if not isinstance(pj, dict) or "content" not in pj:
+    if r.status_code != 200:
         return None
-    
-    # Decode base64 into bytes into a UTF-8 string
+
+    # parse the raw bytes directly; orjson doesn't accept a UTF-8 BOM, so drop it first
     try:
-        raw = base64.b64decode(pj["content"]).decode("utf-8", errors="ignore")
-        return json.loads(raw)
+        return loads(r.content.removeprefix(b"\xef\xbb\xbf"))
     except Exception:
         return None
 
@@ -111,15 +253,18 @@ def simple_curation(pj):
     if cur["monorepo"]: cur["notes"].append("monorepo")
     return cur
 
-def main():
-    repos = load_repos()
-    rows = []
+async def process_repo(client, sem, repo, tip=None):
+    """Freeze one repo and return its corpus row, or None if it failed.
 
-    # Iterate all repos in the list:
-    for repo in repos:
+    `tip` is this repo's result from latest_on_default_batch, if it was resolved there."""
+    async with sem:
         try:
-            license_spdx, sha, date_iso, branch = latest_on_default(repo)
-            pj = fetch_package_json(repo, sha)
+            if tip is None:
+                tip = await latest_on_default(client, repo)
+            elif isinstance(tip, SystemExit):
+                raise tip
+            license_spdx, sha, date_iso, branch = tip
+            pj = await fetch_package_json(client, repo, sha)
             cur = simple_curation(pj)
             row = {
                 "repo": repo,
@@ -128,30 +273,67 @@ def main():
                 "license_spdx": license_spdx,
                 "curation": cur
             }
-            rows.append(row)
-            
+
             # print the progress to the console
             print(f"✔ {repo} @ {sha[:7]}  ({cur['kind']}, tests={str(cur['tests']).lower()}, mono={str(cur['monorepo']).lower()})")
+            return row
         except SystemExit as e:
             print(f"✖ {repo}: {e}")
         except Exception as e:
             print(f"✖ {repo}: {type(e).__name__}: {e}")
+        return None
+
+def md_row(r):
+    """One CORPUS.md table row for a corpus row."""
+    c = r["curation"]
+    return f"| `{r['repo']}` | `{r['commit_sha'][:7]}` | {r['commit_date'][:10]} | {r['license_spdx']} | {c['kind']} | {str(c['tests']).lower()} | {str(c['monorepo']).lower()} |\n"
+
+async def freeze(repos, jsonl_f, md_f):
+    """Freeze all repos concurrently over one shared HTTP/2 client.
+
+    Rows are written to `jsonl_f`/`md_f` as soon as they and every row before them are done,
+    so output keeps repos.txt order and a crash only loses rows still in flight."""
+    sem = asyncio.Semaphore(CONCURRENCY)
+    limits = httpx.Limits(max_connections=CONCURRENCY)
+    async with httpx.AsyncClient(http2=True, headers=HEADERS, limits=limits, timeout=30,
+                                 follow_redirects=True) as client:
+        # GraphQL needs a token; without one every repo goes through the REST calls
+        tips = {}
+        if GITHUB_TOKEN:
+            batches = [repos[i:i + GRAPHQL_BATCH] for i in range(0, len(repos), GRAPHQL_BATCH)]
+            for found in await asyncio.gather(*(latest_on_default_batch(client, sem, b) for b in batches)):
+                tips.update(found)
+
+        tasks = [asyncio.create_task(process_repo(client, sem, r, tips.get(r))) for r in repos]
+        written = 0
+        for task in tasks:
+            row = await task
+            if row is None:
+                continue
+            jsonl_f.write(dumps(row) + b"\n")
+            jsonl_f.flush()
+            md_f.write(md_row(row))
+            md_f.flush()
+            written += 1
+            if written % FSYNC_EVERY == 0:
+                os.fsync(jsonl_f.fileno())
 
-    # write JSONL so this info can be used in other files
-    with open(OUT_JSONL, "w") as f:
-        for r in rows:
-            f.write(json.dumps(r) + "\n")
-
-    # create a markdown table
-    with open(OUT_MD, "w") as f:
-        f.write("# TypeScript Benchmark Corpus\n\n")
-        f.write("_Frozen at latest commit on default branches (at script run time)._  \n")
-        f.write("Columns: repo, short SHA, date, license, kind, tests?, monorepo?\n\n")
-        f.write("| Repo | Commit | Date | License | Kind | Tests | Monorepo |\n")
-        f.write("|---|---|---|---|---|---|---|\n")
-        for r in rows:
-            c = r["curation"]
-            f.write(f"| `{r['repo']}` | `{r['commit_sha'][:7]}` | {r['commit_date'][:10]} | {r['license_spdx']} | {c['kind']} | {str(c['tests']).lower()} | {str(c['monorepo']).lower()} |\n")
+def main():
+    repos = load_repos()
+    _http_cache.update(load_http_cache())
+
+    # write JSONL so this info can be used in other files, plus a markdown table
+    try:
+        with open(OUT_JSONL, "wb") as jsonl_f, open(OUT_MD, "w") as md_f:
+            md_f.write("# TypeScript Benchmark Corpus\n\n")
+            md_f.write("_Frozen at latest commit on default branches (at script run time)._  \n")
+            md_f.write("Columns: repo, short SHA, date, license, kind, tests?, monorepo?\n\n")
+            md_f.write("| Repo | Commit | Date | License | Kind | Tests | Monorepo |\n")
+            md_f.write("|---|---|---|---|---|---|---|\n")
+            asyncio.run(freeze(repos, jsonl_f, md_f))
+    finally:
+        # saved even if the run dies halfway, so the ETags it did collect aren't lost
+        save_http_cache(repos)
 
     print(f"\nWrote {OUT_JSONL} and {OUT_MD}")
 
@@ -1,73 +1,185 @@
 import os
-import json
+import shutil
+import tarfile
+import threading
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
+import requests
 
-SCRIPT_DIR = Path(__file__).resolve().parent
-PROJECT_ROOT = SCRIPT_DIR.parent
+from _common import CORPUS, HEADERS, LOGS_DIR, PROJECT_ROOT, dumps, dumps_indented, loads
 
 # === CONFIG ===
-GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
-HEADERS = {"Authorization": f"token {GITHUB_TOKEN}"} if GITHUB_TOKEN else {}
 BASE_DIR = PROJECT_ROOT / "projects"
 LOG_FILE = PROJECT_ROOT / "skipped_projects.log"
-CORPUS = PROJECT_ROOT / "logs" / "corpus.jsonl"
-LOGS_DIR = PROJECT_ROOT / "logs"
-METADATA_FILE = PROJECT_ROOT / "logs" / "metadata.json"
-REPOS_FILE = PROJECT_ROOT / "repos.txt"
-EXCLUDE_DIRS = {".git", "node_modules", "dist", "build", ".next", "out", "coverage", ".venv", "venv"}
-EXCLUDE_FILE_EXTS = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".pdf", ".svg", ".ico", ".zip", ".gz", ".rar", ".7z"}
-TS_EXTS = {".ts", ".tsx"}
-JS_EXTS = {".js", ".jsx"}
-OTHER_CODE_EXTS = {
+METADATA_FILE = LOGS_DIR / "metadata.json"
+METADATA_JSONL = LOGS_DIR / "metadata.jsonl" # one {repo: metadata} line per repo, written as it's hydrated
+# directories pruned at scandir time, never opened
+EXCLUDE_DIRS = frozenset({
+    ".git", "node_modules", "dist", "build", ".next", "out", "coverage", ".venv", "venv",
+    "__pycache__", ".turbo", ".cache", ".pnpm-store"
+})
+TS_EXTS = frozenset({".ts", ".tsx"})
+JS_EXTS = frozenset({".js", ".jsx"})
+OTHER_CODE_EXTS = frozenset({
     ".py",".java",".go",".rs",".c",".cc",".cpp",".h",".hh",".hpp",
     ".cs",".kt",".swift",".rb",".php",".m",".mm",".scala",".lua",
     ".dart",".sh",".bash",".zsh",".ps1",".r",".pl",".sql",".vue"
-}
+})
+# suffix -> language bucket, so classifying a file is one dict lookup
+_EXT_KIND = {e: "typescript" for e in TS_EXTS} | {e: "javascript" for e in JS_EXTS} | {e: "other" for e in OTHER_CODE_EXTS}
+# tokei does the counting natively when installed; its per-file reports are bucketed by
+# the same suffix rules as the Python counter, so totals don't depend on it being on PATH
+TOKEI = shutil.which("tokei")
 MAX_FILE_BYTES = 10 * 1024 * 1024 # 10 MB
+HYDRATE_WORKERS = (os.cpu_count() or 4) * 2 # repos downloaded + counted at once
+# processes counting lines; defaults to one per core, lower it on spinning disks where reads contend
+LOC_WORKERS = int(os.getenv("LOC_WORKERS") or 0) or None
+CODELOAD_URL = "https://codeload.github.com/{repo}/tar.gz/{sha}"
+SHA_MARKER = ".sha" # written into every checkout, records the extracted commit
+GIT_CACHE_DIR = PROJECT_ROOT / ".git-cache" # bare repos for the git fallback, kept out of projects/
+# trees are built here and renamed into projects/; a sibling so the rename stays on one
+# filesystem, and so a run killed mid-extract leaves nothing bench.js would pick up
+STAGING_DIR = PROJECT_ROOT / ".staging"
+# refuse members that would land outside the destination, where tarfile supports it
+EXTRACT_KW = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+
+# one keep-alive session for every download, with a connection per worker
+_SESSION = requests.Session()
+_SESSION.headers.update(HEADERS)
+_SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=HYDRATE_WORKERS))
+# the ASCII bytes str.strip() drops within a line (bytes.strip() alone keeps \x1c-\x1f)
+_INLINE_WS = b" \t\x0b\x0c\x1c\x1d\x1e\x1f"
+_ASCII_WS = _INLINE_WS + b"\r\n"
+
+_PRINT_LOCK = threading.Lock()
 
 # === HELPER FUNCTIONS ===
 
-def count_loc_by_language(repo_dir):
-    """Count lines of code by language in the given repository directory."""
-    repo_dir = Path(repo_dir)
-    totals = {"typescript": 0, "javascript": 0, "other": 0}
+def log(msg):
+    """print() that keeps lines from worker threads from interleaving."""
+    with _PRINT_LOCK:
+        print(msg, flush=True)
+
+def _nonblank_lines(data):
+    """Non-blank lines in `data`, counted like `line.strip()` over a UTF-8 text-mode read.
+
+    bytes.splitlines() breaks on \n, \r\n and a lone \r, like universal newlines."""
+    if data.isascii():
+        # with the in-line whitespace gone, split() on the \r/\n left yields one chunk per non-blank line
+        return len(data.translate(None, _INLINE_WS).split())
+    # only lines still holding non-ASCII bytes get decoded, so U+00A0 and friends strip
+    # and invalid bytes drop out like they did with errors="ignore"
+    stripped = (line.strip(_ASCII_WS) for line in data.splitlines())
+    return sum(1 for s in stripped if s and (s.isascii() or s.decode("utf-8", "ignore").strip()))
 
-    for root, dirs, files in os.walk(repo_dir):
-        # get all directories except for the big ones we want to skip
-        dirs[:] = [directory for directory in dirs if directory not in EXCLUDE_DIRS]
+def _count_lines(item):
+    """Count the non-blank lines of one (path, codeType, size) file; runs in a worker process."""
+    path, codeType, size = item
+    if size == 0:
+        return codeType, 0
+    try:
+        # bytes.splitlines needs the bytes anyway, so one read() beats a mapping
+        with open(path, "rb") as fh:
+            return codeType, _nonblank_lines(fh.read())
+    except OSError:
+        # vanished or unreadable since the walk
+        return codeType, 0
 
-        for filename in files:
-            p = Path(root) / filename
-            type = p.suffix.lower()
+def _walk_files(top):
+    """Yield a DirEntry for every file under `top`, never descending into EXCLUDE_DIRS."""
+    try:
+        # list eagerly so the directory handle is closed before recursing
+        with os.scandir(top) as it:
+            entries = list(it)
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if entry.name not in EXCLUDE_DIRS:
+                yield from _walk_files(entry.path)
+        elif entry.is_file():
+            yield entry
 
-            # skip obvious non-code or huge files
-            if type in EXCLUDE_FILE_EXTS:
+def _code_kind(name):
+    """Language bucket of a file name by suffix (.d.ts files already end in .ts), or None."""
+    stem, _, ext = name.rpartition(".")
+    return _EXT_KIND.get("." + ext.lower()) if stem else None
+
+def _tokei_lines(stats):
+    """Non-blank lines in one tokei CodeStats: code + comments, plus embedded blobs."""
+    return stats["code"] + stats["comments"] + sum(_tokei_lines(b) for b in stats.get("blobs", {}).values())
+
+def count_loc_with_tokei(repo_dir):
+    """Count lines of code by language with a single tokei run; None if tokei fails."""
+    cmd = [TOKEI, "--output", "json", "--hidden", "--no-ignore"]
+    for directory in EXCLUDE_DIRS:
+        cmd += ["--exclude", directory]
+    cmd.append(str(repo_dir))
+    try:
+        report = loads(subprocess.run(cmd, capture_output=True, check=True).stdout)
+    except (subprocess.CalledProcessError, OSError, ValueError) as e:
+        log(f"[WARN] tokei failed on {repo_dir}, counting in Python: {type(e).__name__}: {e}")
+        return None
+
+    # sum per file rather than per language: tokei's languages also take in suffixes
+    # (.mts, .cjs, .pyi, ...) and shebang scripts the Python counter never looks at
+    totals = {"typescript": 0, "javascript": 0, "other": 0}
+    for language, stats in report.items():
+        if language == "Total":
+            continue
+        for file_report in stats.get("reports", ()):
+            path = file_report["name"]
+            codeType = _code_kind(os.path.basename(path))
+            if codeType is None:
                 continue
+            # tokei has no size limit; skip what the Python counter would skip
             try:
-                # skip files that go over our size limit
-                if p.stat().st_size > MAX_FILE_BYTES:
+                if os.stat(path).st_size > MAX_FILE_BYTES:
                     continue
-            except Exception:
+            except OSError:
                 continue
+            totals[codeType] += _tokei_lines(file_report["stats"])
+    totals["total"] = totals["typescript"] + totals["javascript"] + totals["other"]
+    return totals
 
-            # check what type of code file it is
-            if type in TS_EXTS or filename.lower().endswith(".d.ts"):
-                codeType = "typescript"
-            elif type in JS_EXTS:
-                codeType = "javascript"
-            elif type in OTHER_CODE_EXTS:
-                codeType = "other"
-            else:
-                continue
+def count_loc_by_language(repo_dir, pool=None):
+    """Count lines of code by language in the given repository directory.
 
-            # count all the actual code lines in the file
-            try:
-                with open(p, "r", errors="ignore") as fh:
-                    n = sum(1 for line in fh if line.strip())
-                totals[codeType] += n
-            except Exception:
-                continue
+    Uses tokei when it's on PATH. Otherwise walks the tree in Python and counts lines on
+    `pool` (a ProcessPoolExecutor) if given, else on a pool of its own."""
+    if TOKEI:
+        totals = count_loc_with_tokei(repo_dir)
+        if totals is not None:
+            return totals
+    if pool is None:
+        with ProcessPoolExecutor(max_workers=LOC_WORKERS) as own_pool:
+            return _count_loc_python(repo_dir, own_pool)
+    return _count_loc_python(repo_dir, pool)
+
+def _count_loc_python(repo_dir, pool):
+    """Walk `repo_dir` and count non-blank lines per language bucket on `pool`."""
+    totals = {"typescript": 0, "javascript": 0, "other": 0}
+    code_files = []
+
+    for entry in _walk_files(repo_dir):
+        # check what type of code file it is before any stat, so the common non-code case stays cheap
+        codeType = _code_kind(entry.name)
+        if codeType is None:
+            continue
+        try:
+            size = entry.stat().st_size
+        except OSError:
+            continue
+        # skip files that go over our size limit
+        if size > MAX_FILE_BYTES:
+            continue
+
+        code_files.append((entry.path, codeType, size))
+
+    # count all the actual code lines, sharded across cores since it's CPU bound
+    for codeType, n in pool.map(_count_lines, code_files, chunksize=64):
+        totals[codeType] += n
 
     totals["total"] = totals["typescript"] + totals["javascript"] + totals["other"]
     return totals
@@ -76,19 +188,136 @@ def sh(*args, cwd=None):
     """wrapper for subprocess.check_call."""
     subprocess.check_call(list(args), cwd=cwd)
 
-def clone_or_checkout(repo_full: str, sha: str):
-    """Ensure a working tree exists at projects/<name> and is checked out to `sha`."""
-    owner, name = repo_full.split("/")
+def extract_tar(fileobj, dest, mode="r|gz"):
+    """Stream-extract a tarball into `dest`, dropping its single top-level folder (e.g. `<name>-<sha>/`)."""
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        for member in tar:
+            rel = member.name.partition("/")[2]
+            if not rel or rel.startswith("/") or ".." in rel.split("/"):
+                continue
+            member.name = rel
+            if member.islnk():
+                member.linkname = member.linkname.partition("/")[2]
+            try:
+                tar.extract(member, dest, **EXTRACT_KW)
+            except tarfile.TarError as e:
+                log(f"[WARN] skipped {rel}: {e}")
+
+def replace_tree(dest: Path, sha: str, fill):
+    """Build the tree for `sha` with fill(tmp_dir) in STAGING_DIR, then swap it in for `dest` and mark it with `sha`."""
+    # a failed download/export leaves no half tree behind
+    tmp = STAGING_DIR / dest.name
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    try:
+        fill(tmp)
+        (tmp / SHA_MARKER).write_text(sha + "\n")
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    shutil.rmtree(dest, ignore_errors=True)
+    tmp.rename(dest)
+
+def download_tarball(repo_full: str, sha: str, dest: Path):
+    """Put the tree of `repo_full` at `sha` into `dest`, streamed from codeload (no .git)."""
+    def fill(tmp):
+        with _SESSION.get(CODELOAD_URL.format(repo=repo_full, sha=sha), stream=True, timeout=60) as r:
+            r.raise_for_status()
+            extract_tar(r.raw, tmp)
+    replace_tree(dest, sha, fill)
+
+def git_archive(repo_full: str, sha: str, dest: Path):
+    """Put the tree of `repo_full` at `sha` into `dest` via `git archive` from a bare cache repo (no .git)."""
+    bare = GIT_CACHE_DIR / f"{repo_full.split('/')[1]}.git"
+    if not bare.exists():
+        sh("git", "init", "-q", "--bare", str(bare))
+        sh("git", "remote", "add", "origin", f"https://github.com/{repo_full}.git", cwd=bare)
+
+    # only go to the network if an earlier run hasn't fetched this commit yet.
+    # no blob filter: archive would otherwise fetch missing blobs one at a time.
+    # GitHub serves any reachable commit by id, so when this fails the SHA is gone
+    # (force-pushed away) and fetching history wouldn't find it either; let it raise
+    if subprocess.run(["git", "cat-file", "-e", f"{sha}^{{commit}}"], cwd=bare, stderr=subprocess.DEVNULL).returncode != 0:
+        sh("git", "fetch", "-q", "--depth=1", "origin", sha, cwd=bare)
+
+    def fill(tmp):
+        proc = subprocess.Popen(["git", "archive", "--format=tar", "--prefix=tree/", sha], cwd=bare, stdout=subprocess.PIPE)
+        try:
+            extract_tar(proc.stdout, tmp, mode="r|")
+        finally:
+            proc.stdout.close()
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, "git archive")
+    replace_tree(dest, sha, fill)
+
+def fetch_repo(repo_full: str, sha: str):
+    """Materialize projects/<name> at `sha` as a plain tree: codeload tarball, `git archive` as a fallback."""
+    name = repo_full.split("/")[1]
     dest = BASE_DIR / name
+    marker = dest / SHA_MARKER
+    if marker.exists() and marker.read_text().strip() == sha:
+        return
     BASE_DIR.mkdir(parents=True, exist_ok=True)
+    try:
+        download_tarball(repo_full, sha, dest)
+        return
+    except (requests.RequestException, tarfile.TarError, OSError) as e:
+        log(f"[WARN] tarball failed for {repo_full}, falling back to git: {type(e).__name__}: {e}")
+    GIT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    git_archive(repo_full, sha, dest)
+
+def load_previous_metadata():
+    """Read metadata from the last run, if any.
+
+    metadata.jsonl wins over metadata.json, since it also holds what an interrupted run got through."""
+    prev = {}
+    try:
+        with open(METADATA_FILE, "rb") as f:
+            prev.update(loads(f.read()))
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(METADATA_JSONL, "rb") as f:
+            for line in f:
+                try:
+                    prev.update(loads(line))
+                except ValueError:
+                    continue # e.g. a line cut short by a crash
+    except OSError:
+        pass
+    return prev
+
+def build_metadata(row, loc):
+    """Combine a CORPUS row with its LOC into one metadata entry."""
+    return {
+        "commit_sha": row["commit_sha"],
+        "commit_date": row.get("commit_date"),
+        "license_spdx": row.get("license_spdx"),
+        "curation": row.get("curation"),
+        "loc": loc,
+    }
 
-    # clone if the folder of the project does not exist
-    if not dest.exists():
-      sh("git", "clone", "--filter=blob:none", f"https://github.com/{repo_full}.git", str(dest))
+def hydrate_one(row, prev, loc_pool):
+    """Download/checkout one corpus row and compute its metadata; returns (repo, metadata or None)."""
+    repo = row["repo"]
+    sha = row["commit_sha"]
+    repo_dir = BASE_DIR / repo.split("/")[1]
 
-    # Make sure we have up-to-date references, then checkout the exact commit.
-    sh("git", "fetch", "--all", "--tags", "--prune", cwd=dest)
-    sh("git", "checkout", "-q", sha, cwd=dest)
+    # repos still checked out at an unchanged SHA keep the LOC from the last run
+    old = prev.get(repo) or {}
+    if old.get("commit_sha") == sha and "loc" in old and repo_dir.exists():
+        log(f"[skip] {repo} @ {sha[:7]} unchanged")
+        return repo, build_metadata(row, old["loc"])
+
+    log(f"[checkout] {repo} @ {sha[:7]}")
+    try:
+        fetch_repo(repo, sha)
+        return repo, build_metadata(row, count_loc_by_language(repo_dir, loc_pool))
+    except subprocess.CalledProcessError as e:
+        log(f"[WARN] git failed for {repo}: {e}")
+    except Exception as e:
+        log(f"[WARN] error for {repo}: {type(e).__name__}: {e}")
+    return repo, None
 
 def main():
     # creates directory if not exists, need CORPUS file to run this script
@@ -96,40 +325,32 @@ def main():
     if not CORPUS.exists():
         raise SystemExit(f"Missing corpus file: {CORPUS}. Run freeze_corpus.py first.")
 
+    # binary mode: orjson takes the raw line bytes, no decode step
+    with open(CORPUS, "rb") as f:
+        rows = [loads(line) for line in f if line.strip()]
+
+    prev = load_previous_metadata()
+    BASE_DIR.mkdir(parents=True, exist_ok=True)
     metadata = {}
 
-    with open(CORPUS) as f:
-        for line in f:
-            # go through CORPUS file and get info
-            row = json.loads(line)
-            repo = row["repo"]
-            sha = row["commit_sha"]
-            print(f"[checkout] {repo} @ {sha[:7]}")
+    # each repo's download -> LOC pipeline is independent and mostly waits on the network/disk,
+    # so run them side by side; the CPU-bound line counting shares one process pool
+    # each record is flushed to metadata.jsonl as soon as its repo finishes (completion order, not
+    # corpus order), so a crash loses at most the repos in flight
+    with ProcessPoolExecutor(max_workers=LOC_WORKERS) as loc_pool, ThreadPoolExecutor(max_workers=HYDRATE_WORKERS) as ex, \
+            open(METADATA_JSONL, "wb") as out:
+        futures = [ex.submit(hydrate_one, row, prev, loc_pool) for row in rows]
+        for future in as_completed(futures):
+            repo, meta = future.result()
+            if meta is not None:
+                metadata[repo] = meta
+                out.write(dumps({repo: meta}) + b"\n")
+                out.flush()
 
-            try:
-                clone_or_checkout(repo, sha)
-
-                # compute LOC
-                repo_dir = BASE_DIR / repo.split("/")[1]
-                loc = count_loc_by_language(repo_dir)
-
-                # use CORPUS + LOC to create metadata
-                metadata[repo] = {
-                    "commit_sha": sha,
-                    "commit_date": row.get("commit_date"),
-                    "license_spdx": row.get("license_spdx"),
-                    "curation": row.get("curation"),
-                    "loc": loc,
-                }
-            except subprocess.CalledProcessError as e:
-                print(f"[WARN] git failed for {repo}: {e}")
-            except Exception as e:
-                print(f"[WARN] error for {repo}: {type(e).__name__}: {e}")
-
-    # write the metadata file
-    with open(METADATA_FILE, "w") as out:
-        json.dump(metadata, out, indent=2)
+    # write the consolidated metadata file (sorted, so reruns diff cleanly)
+    with open(METADATA_FILE, "wb") as out:
+        out.write(dumps_indented(metadata, sort_keys=True))
     print(f"[ok] wrote {METADATA_FILE}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()